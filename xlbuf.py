@@ -1,3 +1,9 @@
+import os
+import cPickle as pickle
+import sqlite3
+import tempfile
+import collections
+
 def isstr(a): return isinstance(a, basestring)
 def isdict(a): return isinstance(a, dict)
 
@@ -15,31 +21,127 @@ class OneCell:
         self.fmt_dict = fmt_dict.copy()
 
 
+class DiskCellStore:
+
+    # (y,x) -> OneCell mapping that keeps at most max_cells cells in memory,
+    # least recently used ones are pickled into a temporary sqlite file.
+    # Cells returned by [] are only valid until the next lookup/insert of another cell.
+
+    def __init__(self, max_cells):
+        self.max_cells = max_cells
+        self.mem = collections.OrderedDict()
+        fd, self.filename = tempfile.mkstemp(prefix='xml2xl_', suffix='.sqlite')
+        os.close(fd)
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("CREATE TABLE cells (y INTEGER, x INTEGER, data BLOB, PRIMARY KEY (y, x))")
+
+    def __contains__(self, key):
+        if key in self.mem: return True
+        return self.db.execute("SELECT 1 FROM cells WHERE y=? AND x=?", key).fetchone() is not None
+
+    def __getitem__(self, key):
+        if key in self.mem:
+            cell = self.mem.pop(key)
+        else:
+            row = self.db.execute("SELECT data FROM cells WHERE y=? AND x=?", key).fetchone()
+            if row is None: raise KeyError(key)
+            cell = pickle.loads(str(row[0]))
+        self[key] = cell
+        return cell
+
+    def __setitem__(self, key, cell):
+        self.mem.pop(key, None)
+        self.mem[key] = cell # most recently used go last
+        if len(self.mem) > self.max_cells:
+            # spill the oldest quarter in one go, but never the cell that was just touched
+            self.spill(min(max(1, self.max_cells/4), len(self.mem) - 1))
+
+    def spill(self, n=None):
+        if n is None: n = len(self.mem)
+        rows = []
+        for i in range(min(n, len(self.mem))):
+            (y,x), cell = self.mem.popitem(last=False)
+            rows.append((y, x, sqlite3.Binary(pickle.dumps(cell, pickle.HIGHEST_PROTOCOL))))
+        self.db.executemany("INSERT OR REPLACE INTO cells VALUES (?, ?, ?)", rows)
+
+    def itervalues(self):
+        # all cells, in row order
+        self.spill()
+        for (data,) in self.db.execute("SELECT data FROM cells ORDER BY y, x"):
+            yield pickle.loads(str(data))
+
+    def close(self):
+        if self.db is None: return
+        self.db.close()
+        self.db = None
+        os.remove(self.filename)
+
+
 class CellBuffer:
 
-    def __init__(self, workbook, default_fmt_dict):
-        self.buf = {}
+    def __init__(self, workbook, default_fmt_dict, max_cells = None):
+        # keep all the cells in memory, unless asked to bound that
+        if max_cells is not None and max_cells < 1:
+            raise Exception("max_cells has to be at least 1, got %s"%max_cells)
+        self.buf = {} if max_cells is None else DiskCellStore(max_cells)
         self.fmt_buf = {}
-        self.default_fmt_dict = default_fmt_dict 
+        # expanded like any other cell format, so that a cell never holds both "border"
+        # and the side keys from draw_range_border(), which xlsxwriter resolves by dict order
+        self.default_fmt_dict = self.expand_borders(default_fmt_dict)
         self.workbook = workbook
         self.row_format = {}
         self.num_urls = 0
+        self.num_urls_written = 0
+        self.num_urls_dropped = 0
+        self.num_cells = 0
+        self.num_rich_strings = 0
+        self.num_comments = 0
+        self.merges = [] # merged ranges, applied on write_all
 
 
     def cell(self, y, x, val = None, fmt_dict = None, comment = None, ref = None, url = None):
         # create the cell, if needed
-        if (y,x) not in self.buf:
-            self.buf[y,x] = OneCell(y, x, val, self.default_fmt_dict, comment, ref, url)
+        if (y,x) in self.buf:
+            cell = self.buf[y,x]
+        else:
+            cell = OneCell(y, x, val, self.default_fmt_dict, comment, ref, url)
+            self.buf[y,x] = cell
 
-        # update value and formats
+        # update value, formats and link
         if val is not None:
-            self.buf[y,x].val = val
-            self.buf[y,x].calc_val = val
+            cell.val = val
+            cell.calc_val = val
 
         if fmt_dict is not None:
-            self.buf[y,x].fmt_dict.update(self.expand_borders(fmt_dict))
+            cell.fmt_dict.update(self.expand_borders(fmt_dict))
+
+        if url is not None:
+            cell.url = url
+
+        return cell
 
-        return self.buf[y,x]
+
+    def merge_cells(self, cells):
+        # layer (y, x, val, fmt_dict) tuples rendered by another buffer on top of this one,
+        # fmt_dict is expected to have its borders expanded already
+        buf = self.buf
+        for (y, x, val, fmt_dict) in cells:
+            if (y,x) in buf:
+                cell = buf[y,x]
+                if val is not None:
+                    cell.val = val
+                    cell.calc_val = val
+                cell.fmt_dict.update(fmt_dict)
+            else:
+                cell = OneCell(y, x, val, self.default_fmt_dict, None, None, None)
+                cell.fmt_dict.update(fmt_dict)
+                buf[y,x] = cell
+
+
+    def merge_range(self, r1, c1, r2, c2):
+        self.merges.append((r1, c1, r2, c2))
 
 
     def get_xl_fmt(self, fmt_dict):
@@ -137,7 +239,20 @@ class CellBuffer:
     def write_all(self, worksheet, out_cell_fmt):
         #ff = open('/tmp/test.txt', 'w')
         MAX_URLS = 65530
+        # A merge goes right before its top-left cell, as merge_range() writes that cell blank.
+        # Spilled cells come in row order, so merges are kept in that order as well,
+        # as required by xlsxwriter's constant_memory mode
+        merges = sorted(self.merges)
+        if not isinstance(self.buf, DiskCellStore):
+            for (r1, c1, r2, c2) in merges:
+                worksheet.merge_range(r1, c1, r2, c2, '')
+            merges = []
+        imerge = 0
         for cell in self.buf.itervalues():
+            while imerge < len(merges) and merges[imerge][:2] <= (cell.y, cell.x):
+                worksheet.merge_range(*(merges[imerge] + ('',)))
+                imerge += 1
+            self.num_cells += 1
             fmt_dict = {}
             fmt_dict.update(cell.fmt_dict)
             if cell.y in self.row_format:
@@ -150,6 +265,7 @@ class CellBuffer:
                     print "Warning: exceeded %d URLs per sheet, ignoring the rest"%MAX_URLS
                 if self.num_urls > MAX_URLS:
                     cell.url = None
+                    self.num_urls_dropped += 1
             if cell.url is None:
                 if isstr(cell.val) or cell.val is None:
                     worksheet.write(cell.y, cell.x, cell.val, fmt)
@@ -158,9 +274,21 @@ class CellBuffer:
                     opt_vals = self.optimize_str_formatting(cell.val)
                     values = [x if isstr(x) else self.get_xl_fmt(x) for x in opt_vals]
                     values.append(fmt)
-                    worksheet.write_rich_string(cell.y, cell.x, *values)
+                    # xlsxwriter ignores rich strings of less than 2 fragments, count only written ones
+                    if worksheet.write_rich_string(cell.y, cell.x, *values) == 0:
+                        self.num_rich_strings += 1
                     #ff.write("%s %s %s\n"%(cell.x, cell.y, values))
             else:
+                self.num_urls_written += 1
                 worksheet.write_url(cell.y, cell.x, cell.url, fmt, cell.val)
             if cell.comment is not None:
+                self.num_comments += 1
                 worksheet.write_comment(cell.y, cell.x, cell.comment, {'x_scale': 3.0, 'y_scale': 0.6})
+        for merge in merges[imerge:]:
+            worksheet.merge_range(*(merge + ('',)))
+        self.close()
+
+    def close(self):
+        # drop the spill file, if any
+        if isinstance(self.buf, DiskCellStore):
+            self.buf.close()
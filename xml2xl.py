@@ -1,13 +1,23 @@
+import os
 import re
+import gc
+import sys
 import json
 import copy
 import glob
+import time
 import string
+import contextlib
 import xlbuf
 import argparse
+import multiprocessing
 import xlsxwriter
 import formatters
 import xml.etree.cElementTree as ET
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
 
 KEYWORDS = ('name', 'format', 'ignore', 'comment', 'row', 'col', 'xml',
 'xml_select', 'entries', 'prefix', 'suffix', 'separator', 'active',
@@ -46,6 +56,88 @@ def arr2str(arr):
 def stub_msg_callback(s):
     return
 
+# (dad, sheet, entry, fmt, records) of the sheet being rendered in parallel,
+# inherited by the forked workers instead of being pickled for each of them
+_parallel_job = None
+
+def render_records(span):
+    # worker side of XML2XL.process_entry_parallel(): render records [i0, i1) into a private buffer
+    dad, sheet, entry, fmt, records = _parallel_job
+    i0, i1 = span
+    # rendering creates no reference cycles, and the collector walking
+    # the growing buffer over and over costs more than the rendering itself
+    gc.disable()
+    buf = xlbuf.CellBuffer(None, {}) # no default format, so the parent can layer cells on top of each other
+    sheet.need_url = []
+    Sheet.cellref = {}
+    cursor = records[i0][1].copy()
+    for i in range(i0, i1):
+        child_entry, start = records[i]
+        if cursor.state() != start.state():
+            raise Exception("At %s: row pre-pass mismatch, expected cursor %s, got %s"%(child_entry['json_path'], start.state(), cursor.state()))
+        dad.process_entry(sheet, child_entry, cursor, buf, fmt)
+        if i < len(records) - 1:
+            dad.move_cursor(entry, cursor)
+    # cells go back as compact (y, x, val, fmt_dict) tuples, cheaper to pickle than OneCell instances
+    cells = [(c.y, c.x, c.val, c.fmt_dict) for c in buf.buf.itervalues()]
+    return cells, buf.merges, sheet.need_url, Sheet.cellref, cursor.state()
+
+class Stats:
+
+    # Run statistics: wall/CPU time per phase, peak memory and per-sheet output counters
+
+    def __init__(self):
+        self.phases = []
+        self.sheets = []
+        self.format_keys = set() # formats are cached per sheet, the same one may be created on several
+        self.peak_rss_kb = None
+        self.peak_rss_children_kb = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # CPU time includes the finished worker processes
+        wall, cpu = time.time(), sum(os.times()[:4])
+        try:
+            yield
+        finally:
+            self.phases.append({'name': name, 'wall': time.time() - wall, 'cpu': sum(os.times()[:4]) - cpu})
+
+    def add_sheet(self, name, buf):
+        self.sheets.append({'name': name, 'cells': buf.num_cells, 'rich_strings': buf.num_rich_strings,
+            'urls': buf.num_urls_written, 'urls_dropped': buf.num_urls_dropped,
+            'comments': buf.num_comments, 'formats': len(buf.fmt_buf)})
+        self.format_keys.update(buf.fmt_buf.keys())
+
+    def update_rss(self):
+        if resource is None: return
+        # ru_maxrss is in kilobytes, except for macOS where it is in bytes
+        scale = 1024 if sys.platform == 'darwin' else 1
+        self.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        self.peak_rss_children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+    def as_dict(self):
+        return {'phases': self.phases, 'sheets': self.sheets,
+                'formats': len(self.format_keys),
+                'formats_created': sum(x['formats'] for x in self.sheets),
+                'peak_rss_kb': self.peak_rss_kb, 'peak_rss_children_kb': self.peak_rss_children_kb}
+
+    def report(self):
+        lines = ["%-40s %10s %10s"%("phase", "wall, s", "cpu, s")]
+        for p in self.phases:
+            lines.append("%-40s %10.3f %10.3f"%(p['name'], p['wall'], p['cpu']))
+        lines.append("")
+        lines.append("%-30s %10s %10s %10s %10s %10s %10s"%("sheet", "cells", "rich", "urls", "dropped", "comments", "formats"))
+        for x in self.sheets:
+            # name may be None, for xml_select_sheet without select_name text
+            lines.append("%-30s %10d %10d %10d %10d %10d %10d"%(("%s"%x['name'])[:30], x['cells'], x['rich_strings'],
+                x['urls'], x['urls_dropped'], x['comments'], x['formats']))
+        lines.append("")
+        d = self.as_dict()
+        lines.append("distinct formats: %d (add_format calls: %d)"%(d['formats'], d['formats_created']))
+        if self.peak_rss_kb is not None:
+            lines.append("peak RSS: %d kB (workers: %d kB)"%(self.peak_rss_kb, self.peak_rss_children_kb))
+        return "\n".join(lines)
+
 class Cursor:
     
     # 2D pointer with max coord tracking
@@ -65,6 +157,9 @@ class Cursor:
         c.max_col = self.max_col
         return c
 
+    def state(self):
+        return (self.row, self.col, self.max_row, self.max_col)
+
 class XLName:
     def __init__(self, names = []):
         self.name_map = {}
@@ -97,7 +192,7 @@ class Sheet:
         self.need_url = [] # cells that need urls on this sheet
         self.cell_fmt = {} # keeps track of cell formatting for xlbuf
         self.xlsheet = dad.workbook.add_worksheet(self.dad.xlname[self.cfg['name']])
-        self.cellbuf = xlbuf.CellBuffer(dad.workbook, dad.default_fmt)
+        self.cellbuf = xlbuf.CellBuffer(dad.workbook, dad.default_fmt, dad.max_cells)
         self.column_formats = {}
         self.column_widths = {}
         self.column_headers = []
@@ -107,12 +202,13 @@ class Sheet:
 
     def write_all(self):
         self.cellbuf.write_all(self.xlsheet, self.cell_fmt)
+        self.dad.stats.add_sheet(self.cfg['name'], self.cellbuf)
 
     def post_process(self):
-        for (cell_from, sheet_to_name, link_id) in self.need_url:
-            cell_to = Sheet.cellref[(sheet_to_name, link_id)]
-            xlref = xlsxwriter.utility.xl_rowcol_to_cell(cell_to.y, cell_to.x, False, False) 
-            cell_from.url = "internal:'%s'!%s"%(self.dad.xlname[sheet_to_name], xlref)
+        for (y, x, sheet_to_name, link_id) in self.need_url:
+            y_to, x_to = Sheet.cellref[(sheet_to_name, link_id)]
+            xlref = xlsxwriter.utility.xl_rowcol_to_cell(y_to, x_to, False, False) 
+            self.cellbuf.cell(y, x, url="internal:'%s'!%s"%(self.dad.xlname[sheet_to_name], xlref))
 
     def process(self):
 
@@ -151,7 +247,10 @@ class Sheet:
         root_entry = self.cfg
         root_entry['xml_nodes'] = [self.xml] # root node is our starting hierarchy
         root_entry['json_path'] = "sheet(%s)"%self.cfg['name'] # keep track of path for debugging
-        self.dad.process_entry(self, root_entry, self.cursor, self.cellbuf, self.dad.default_fmt)
+        if self.dad.workers > 1:
+            self.dad.process_entry_parallel(self, root_entry, self.cursor, self.cellbuf, self.dad.default_fmt)
+        else:
+            self.dad.process_entry(self, root_entry, self.cursor, self.cellbuf, self.dad.default_fmt)
 
         # Make this sheet default active one, if requested
         if self.cfg.get('active', False):
@@ -173,7 +272,7 @@ class Sheet:
 class XML2XL:
 
     def __init__(self):
-        pass
+        self.moves_cache = {} # parsed "row"/"col" values, see parse_moves()
 
 
     def filtercfg_skip(self, entry, filtercfg):
@@ -205,26 +304,42 @@ class XML2XL:
 
     def et2xl(self, element_tree, cfg_filename, output_filename, properties = None,
             text_formatter = formatters.xml_strip_formatter, msg_callback = stub_msg_callback,
-            filtercfg = None):
+            filtercfg = None, workers = 1, max_cells = None, stats = None):
         """
         Process XML element tree and write formatted Excel output
+        With workers > 1, the top-level records of each sheet are rendered in parallel processes
+        With max_cells set, each sheet keeps at most that many cells in memory and spills the rest to disk,
+        the workbook is written in constant_memory mode. Can't be combined with workers > 1
+        Returns the Stats of the run, added to the given stats object if any
         """
 
-        if cfg_filename.endswith('.json'):
-            cfg = json.load(open(cfg_filename))
-        else:
-            config = {}
-            execfile(cfg_filename, config)
-            try:
-                cfg = config['xlmap']
-            except:
-                raise Exception("'xlmap' not defined in %s"%cfg_filename)
+        if stats is None: stats = Stats()
+        self.stats = stats
+
+        with stats.phase("config load"):
+            if cfg_filename.endswith('.json'):
+                cfg = json.load(open(cfg_filename))
+            else:
+                config = {}
+                execfile(cfg_filename, config)
+                try:
+                    cfg = config['xlmap']
+                except:
+                    raise Exception("'xlmap' not defined in %s"%cfg_filename)
         self.xml = element_tree
         self.text_formatter = text_formatter
+        self.workers = workers
+        self.max_cells = max_cells
 
         self.cfg = self.copy_with_filter(cfg, filtercfg)
 
-        self.workbook = xlsxwriter.Workbook(output_filename)
+        if max_cells is not None and workers > 1:
+            # workers hand back whole chunks of cells, that would defeat the memory bound
+            raise Exception("max_cells can't be combined with workers > 1")
+
+        # Spilled cells are written back in row order, so xlsxwriter doesn't
+        # have to keep them all in memory either
+        self.workbook = xlsxwriter.Workbook(output_filename, {'constant_memory': self.max_cells is not None})
         if properties is not None and properties != "":
             if isinstance(properties, basestring):
                 a = properties.split(';')
@@ -234,44 +349,55 @@ class XML2XL:
         self.default_fmt = self.cfg['formats']['DEFAULT']
 
         sheets = []
-        for cfg in self.cfg['sheets']:
-            xss = cfg.get('xml_select_sheet', None)
-            # xml_select_sheet allows to select parts of the hierarchy
-            # and process each as a separate sheet
-            xfs = cfg.get('xml_filter_sheet', None)
-            # xml_filter_sheet allows to split single hierarchy into sheets
-            # according to the value of a given selector 
-            self.xlname = XLName() # identity map
-            if xss is not None:
-                for mxml in self.xml.findall(xss['select_path']):
-                    mcfg = copy.deepcopy(cfg)
-                    mcfg['name'] = mxml.findtext(xss['select_name'])
-                    sheets.append(Sheet(mcfg, self, mxml))
-            elif xfs is not None:
-                sheet_names = sorted(set([x.text for x in self.xml.findall(xfs)]))
-                self.xlname = XLName(sheet_names)
-                for sheet_name in sheet_names:
-                    mcfg = copy.deepcopy(cfg)
-                    mcfg['name'] = sheet_name
-                    sheets.append(Sheet(mcfg, self, self.xml))
-            else:
-                sheets.append(Sheet(cfg, self, self.xml))
+        try:
+            for cfg in self.cfg['sheets']:
+                xss = cfg.get('xml_select_sheet', None)
+                # xml_select_sheet allows to select parts of the hierarchy
+                # and process each as a separate sheet
+                xfs = cfg.get('xml_filter_sheet', None)
+                # xml_filter_sheet allows to split single hierarchy into sheets
+                # according to the value of a given selector 
+                self.xlname = XLName() # identity map
+                if xss is not None:
+                    for mxml in self.xml.findall(xss['select_path']):
+                        mcfg = copy.deepcopy(cfg)
+                        mcfg['name'] = mxml.findtext(xss['select_name'])
+                        sheets.append(Sheet(mcfg, self, mxml))
+                elif xfs is not None:
+                    sheet_names = sorted(set([x.text for x in self.xml.findall(xfs)]))
+                    self.xlname = XLName(sheet_names)
+                    for sheet_name in sheet_names:
+                        mcfg = copy.deepcopy(cfg)
+                        mcfg['name'] = sheet_name
+                        sheets.append(Sheet(mcfg, self, self.xml))
+                else:
+                    sheets.append(Sheet(cfg, self, self.xml))
 
-        # First pass, populate all the data
-        for sheet in sheets:
-            msg_callback("processing sheet '%s'"%sheet.cfg['name'])
-            sheet.process()
+            # First pass, populate all the data
+            for sheet in sheets:
+                msg_callback("processing sheet '%s'"%sheet.cfg['name'])
+                with stats.phase("process sheet '%s'"%sheet.cfg['name']):
+                    sheet.process()
         
-        # Populate links
-        msg_callback("populating links")
-        for sheet in sheets: sheet.post_process()
-
-        # Dump the buffers
-        msg_callback("writing output: " + output_filename)
-        for sheet in sheets: sheet.write_all()
+            # Populate links
+            msg_callback("populating links")
+            with stats.phase("link resolution"):
+                for sheet in sheets: sheet.post_process()
+
+            # Dump the buffers
+            msg_callback("writing output: " + output_filename)
+            with stats.phase("write"):
+                for sheet in sheets: sheet.write_all()
+        finally:
+            # remove the spilled cells also when processing fails half way
+            for sheet in sheets: sheet.cellbuf.close()
 
         msg_callback("Closing the workbook")
-        self.workbook.close()
+        with stats.phase("workbook close"):
+            self.workbook.close()
+
+        stats.update_rss()
+        return stats
 
 
     def process_entry(self, sheet, entry, cursor, buf, fmt, link_to=None, link_id=None):
@@ -304,13 +430,15 @@ class XML2XL:
                     #ref = xlsxwriter.utility.xl_rowcol_to_cell(cursor.row, cursor.col, True, True)
                     #self.workbook.define_name(str("%s__%s"%(self.sheet_cfg['name'], link_id)).translate(TR), "='%s'!%s"%(self.sheet_cfg['name'], ref))
                     #self.last_link = str("%s__%s"%(link_to, link_id)).translate(TR)
-                    cell = buf.cell(cursor.row, cursor.col, text, cell_fmt)
-                    Sheet.cellref[(sheet.cfg['name'], link_id)] = cell # keep the reference to the cell so we can link on 2nd pass
-                    sheet.need_url.append((cell, link_to, link_id))
+                    buf.cell(cursor.row, cursor.col, text, cell_fmt)
+                    # keep the cell coordinates so we can link on 2nd pass. Not the cell itself,
+                    # the buffer may have spilled it to disk by then
+                    Sheet.cellref[(sheet.cfg['name'], link_id)] = (cursor.row, cursor.col)
+                    sheet.need_url.append((cursor.row, cursor.col, link_to, link_id))
                 # merge cells if requested
                 span = entry.get('span', None)
                 if span is not None:
-                    sheet.xlsheet.merge_range(cursor.row, cursor.col, cursor.row+span[0]-1, cursor.col+span[1]-1, '')
+                    buf.merge_range(cursor.row, cursor.col, cursor.row+span[0]-1, cursor.col+span[1]-1)
             return entry["text"]
         
         try:
@@ -364,41 +492,7 @@ class XML2XL:
         if 'xml_select' in entry:
             raise Exception("At %s: xml_select entry can only appear directly under the 'entries' list"%json_path)
         if 'entries' in entry:
-            # Populate the list of children to iterate over
-            child_entries = []
-            
-            if entry['entries'] == '#column_headers':
-                # Special format for column headers population from the list of column formats 
-                entry['entries'] = sheet.column_headers
-                for e in entry['entries']:
-                    if e.get('width', None) == 0 or e['text'] == '':
-                        e['no_commit'] = True
-            
-            for i,child_entry in enumerate(entry['entries']):
-                if isinstance(child_entry, dict) and ("xml_select" in child_entry):
-                    # expand the xml_select into 0..+inf child entries
-                    path = child_entry['xml_select'].replace('%SHEETNAME%', sheet.cfg['name'])
-                    if not isinstance(path, basestring):
-                        raise Exception("At %s/entries[%d]: xml_select value has to be a string path, instead got %s"%(json_path, i, path))
-                    imax = None
-                    if path.startswith('!'): # Take first found element only
-                        path = path[1:]
-                        imax = 1
-                    child_xml_nodes = xml_nodes[-1].findall(path)[0:imax]
-                    for child_xml_node in child_xml_nodes:
-                        new_entry = child_entry.copy()
-                        del new_entry['xml_select']
-                        new_entry['xml_nodes'] = xml_nodes + [child_xml_node]
-                        new_entry['json_path'] = json_path + "/xml_select(%s)"%path
-                        child_entries.append(new_entry)
-                else:
-                    # shortcuts for the user
-                    if isinstance(child_entry, basestring) or isinstance(child_entry, list):
-                        child_entry = {"text": child_entry}
-                    # append list of child entries to process, at same XML hierarchy
-                    child_entry['xml_nodes'] = xml_nodes
-                    child_entry['json_path'] = json_path + "/entries[%d]"%i
-                    child_entries.append(child_entry)
+            child_entries = self.expand_entries(sheet, entry, xml_nodes, json_path)
 
             # Now walk over children
             for i,child_entry in enumerate(child_entries):
@@ -455,6 +549,163 @@ class XML2XL:
             return self.process_entry(sheet, leaf_entry, cursor, buf, fmt, entry.get('link_to', None), link_id)
 
 
+    def process_entry_parallel(self, sheet, entry, cursor, buf, fmt):
+        # Same as process_entry() for a sheet root, but renders the top-level records in worker processes.
+        # Record start positions are found by a cheap cursor-only pre-pass (see measure_entry),
+        # so every worker can start writing at the right offset.
+        global _parallel_job
+
+        if 'text' in entry or 'entries' not in entry or not ('row' in entry or 'col' in entry) \
+                or not hasattr(os, 'fork'):
+            # single cell or no cursor moves: nothing to split. Workers rely on fork to inherit the tree
+            return self.process_entry(sheet, entry, cursor, buf, fmt)
+
+        for key in entry.keys():
+            if key not in KEYWORDS:
+                raise Exception('Unrecognized keyword:', key)
+
+        new_fmt = self.try_fmt(entry, 'format')
+        if new_fmt is not None:
+            fmt = fmt.copy()
+            fmt.update(new_fmt)
+
+        entry_start_cursor = cursor.copy()
+        child_entries = self.expand_entries(sheet, entry, entry['xml_nodes'], entry['json_path'])
+        if len(child_entries) < 2*self.workers:
+            return self.process_entry(sheet, entry, cursor, buf, fmt)
+
+        # Pre-pass: cursor position in front of every record
+        records = []
+        for i,child_entry in enumerate(child_entries):
+            records.append((child_entry, cursor.copy()))
+            self.measure_entry(sheet, child_entry, child_entry['xml_nodes'], cursor)
+            if i < len(child_entries) - 1:
+                self.move_cursor(entry, cursor)
+
+        # A few chunks per worker to even out the records of different size
+        nchunks = 4*self.workers
+        step = (len(records) + nchunks - 1) / nchunks
+        spans = [(i, min(i + step, len(records))) for i in range(0, len(records), step)]
+
+        _parallel_job = (self, sheet, entry, fmt, records)
+        pool = multiprocessing.Pool(self.workers)
+        gc_enabled = gc.isenabled()
+        gc.disable() # same as in render_records()
+        try:
+            # Merge in record order, so later records overwrite earlier ones same as in serial mode
+            for i, result in enumerate(pool.imap(render_records, spans)):
+                i0, i1 = spans[i]
+                cells, merges, need_url, cellref, end_state = result
+                expected = cursor.state() if i1 == len(records) else records[i1][1].state()
+                if end_state != expected:
+                    raise Exception("At %s: row pre-pass mismatch, expected cursor %s, got %s"%(records[i1-1][0]['json_path'], expected, end_state))
+                buf.merge_cells(cells)
+                buf.merges += merges
+                sheet.need_url += need_url
+                Sheet.cellref.update(cellref)
+            pool.close()
+        finally:
+            if gc_enabled: gc.enable()
+            pool.terminate()
+            pool.join()
+            _parallel_job = None
+
+        border = entry.get('draw_border', None)
+        if border is not None:
+            lt = [entry_start_cursor.row, entry_start_cursor.col]
+            rb = [cursor.max_row, cursor.max_col]
+            buf.draw_range_border(lt, rb, border.get("type", None), border.get("color", None))
+
+
+    def measure_entry(self, sheet, entry, xml_nodes, cursor):
+        # Cursor-only dry run of process_entry(): moves the cursor (incl. max tracking)
+        # exactly like rendering the entry would, without evaluating any text.
+        # Walks the config as is, rather than expanding per-record copies of the entries
+        if cursor is None: return
+        if self.is_leaf(entry):
+            if self.is_committed(entry): cursor.update_max()
+            return
+        if 'entries' not in entry: return
+        self.resolve_column_headers(sheet, entry)
+        moves = self.parse_moves(entry)
+        first = True
+        for child_entry in entry['entries']:
+            if isinstance(child_entry, dict) and ("xml_select" in child_entry):
+                path, child_xml_nodes = self.select_nodes(sheet, child_entry['xml_select'], xml_nodes)
+                child_xml_nodes_list = [xml_nodes + [x] for x in child_xml_nodes]
+            else:
+                child_xml_nodes_list = [xml_nodes]
+            # leaves are handled in place, they are the bulk of the calls
+            leaf = self.is_leaf(child_entry)
+            commit = leaf and self.is_committed(child_entry)
+            for child_xml_nodes in child_xml_nodes_list:
+                if not first:
+                    for (key, relative, n) in moves:
+                        setattr(cursor, key, getattr(cursor, key) + n if relative else n)
+                first = False
+                if not leaf:
+                    self.measure_entry(sheet, child_entry, child_xml_nodes, cursor)
+                elif commit:
+                    cursor.update_max()
+
+
+    def is_leaf(self, entry):
+        # text, or children folded into a single cell at the cursor
+        return not isinstance(entry, dict) or 'text' in entry or not ('row' in entry or 'col' in entry)
+
+
+    def is_committed(self, entry):
+        return not (isinstance(entry, dict) and entry.get('no_commit', False))
+
+
+    def resolve_column_headers(self, sheet, entry):
+        if entry['entries'] == '#column_headers':
+            # Special format for column headers population from the list of column formats 
+            entry['entries'] = sheet.column_headers
+            for e in entry['entries']:
+                if e.get('width', None) == 0 or e['text'] == '':
+                    e['no_commit'] = True
+
+
+    def select_nodes(self, sheet, path, xml_nodes):
+        # xml_select path -> (path without the '!' prefix, selected xml nodes)
+        path = path.replace('%SHEETNAME%', sheet.cfg['name'])
+        imax = None
+        if path.startswith('!'): # Take first found element only
+            path = path[1:]
+            imax = 1
+        return path, xml_nodes[-1].findall(path)[0:imax]
+
+
+    def expand_entries(self, sheet, entry, xml_nodes, json_path):
+        # Populate the list of children to iterate over
+        child_entries = []
+        
+        self.resolve_column_headers(sheet, entry)
+        
+        for i,child_entry in enumerate(entry['entries']):
+            if isinstance(child_entry, dict) and ("xml_select" in child_entry):
+                # expand the xml_select into 0..+inf child entries
+                if not isinstance(child_entry['xml_select'], basestring):
+                    raise Exception("At %s/entries[%d]: xml_select value has to be a string path, instead got %s"%(json_path, i, child_entry['xml_select']))
+                path, child_xml_nodes = self.select_nodes(sheet, child_entry['xml_select'], xml_nodes)
+                for child_xml_node in child_xml_nodes:
+                    new_entry = child_entry.copy()
+                    del new_entry['xml_select']
+                    new_entry['xml_nodes'] = xml_nodes + [child_xml_node]
+                    new_entry['json_path'] = json_path + "/xml_select(%s)"%path
+                    child_entries.append(new_entry)
+            else:
+                # shortcuts for the user
+                if isinstance(child_entry, basestring) or isinstance(child_entry, list):
+                    child_entry = {"text": child_entry}
+                # append list of child entries to process, at same XML hierarchy
+                child_entry['xml_nodes'] = xml_nodes
+                child_entry['json_path'] = json_path + "/entries[%d]"%i
+                child_entries.append(child_entry)
+        return child_entries
+
+
     def try_fmt(self, dic, key):
         fmt = dic.get(key, None)
         if fmt is not None:
@@ -462,14 +713,24 @@ class XML2XL:
         return fmt
 
 
+    def parse_moves(self, entry):
+        # "row"/"col" cursor moves of the entry, as (key, relative, offset) tuples
+        spec = (entry.get('row', None), entry.get('col', None))
+        if spec in self.moves_cache: return self.moves_cache[spec]
+        moves = []
+        for key, a in zip(("row", "col"), spec):
+            if a is not None:
+                if a.startswith('+'): moves.append((key, True, int(a[1:])))
+                elif a.startswith('-'): moves.append((key, True, -int(a[1:])))
+                else: moves.append((key, False, int(a)))
+        self.moves_cache[spec] = moves
+        return moves
+
+
     def move_cursor(self, entry, cursor):
-        for key in ("row", "col"):
-            if key in entry:
-                if cursor is None: raise Exception("No cursor at " + entry['json_path'])
-                a = entry[key]
-                if a.startswith('+'): setattr(cursor, key, getattr(cursor, key) + int(a[1:]))
-                elif a.startswith('-'): setattr(cursor, key, getattr(cursor, key) - int(a[1:]))
-                else: setattr(cursor, key, int(a))
+        for (key, relative, n) in self.parse_moves(entry):
+            if cursor is None: raise Exception("No cursor at " + entry['json_path'])
+            setattr(cursor, key, getattr(cursor, key) + n if relative else n)
 
 
 if __name__ == "__main__":
@@ -479,8 +740,15 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--cfg", required=True, help="Config (.json) file name")
     parser.add_argument("-o", "--output", help="Output (.xlsx) file name")
     parser.add_argument("-C", "--filtercfg", help="Field filter config")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes to render each sheet's records with")
+    parser.add_argument("-m", "--max-cells", type=int, help="Max number of cells per sheet to keep in memory, the rest is spilled to a temp file. Not compatible with --jobs")
+    parser.add_argument("-s", "--stats", nargs='?', const='text', choices=('text', 'json'), help="Print run statistics, as a table or as JSON")
     parser.add_argument("-p", "--properties", help="Set of properties to embed into the doc, in the form: prop1:blah blah;prop2:meh meh")
     args = parser.parse_args()
+    if args.max_cells is not None and args.max_cells < 1:
+        parser.error("--max-cells has to be at least 1")
+    if args.max_cells is not None and args.jobs > 1:
+        parser.error("--max-cells can't be combined with --jobs")
 
     filenames = []
     for fnglob in args.xml:
@@ -492,12 +760,20 @@ if __name__ == "__main__":
         if not args.output.endswith(".xlsx"):
             raise Exception("Output file name should have .xlsx extension")
 
-    top = ET.Element('top')
-    for fxml in filenames:
-        element_tree = ET.parse(fxml)
-        for elem in element_tree.getroot():
-            # Merge all given XMLs under under the same root
-            top.append(elem)
+    stats = Stats()
+    with stats.phase("XML parse"):
+        top = ET.Element('top')
+        for fxml in filenames:
+            element_tree = ET.parse(fxml)
+            for elem in element_tree.getroot():
+                # Merge all given XMLs under under the same root
+                top.append(elem)
 
     print "Writing:", args.output 
-    XML2XL().et2xl(top, args.cfg, args.output, properties = args.properties, filtercfg = args.filtercfg)
+    XML2XL().et2xl(top, args.cfg, args.output, properties = args.properties, filtercfg = args.filtercfg,
+            workers = args.jobs, max_cells = args.max_cells, stats = stats)
+
+    if args.stats == 'json':
+        print json.dumps(stats.as_dict(), indent=2)
+    elif args.stats == 'text':
+        print stats.report()